@@ -1,84 +1,120 @@
 import streamlit as st
 import pdfplumber, re, pandas as pd, io
-from collections import defaultdict
+import numpy as np
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from operator import itemgetter
 
 st.set_page_config(page_title="Valeo → XLSX (auto-detect)", layout="wide")
 st.title("Valeo PDF → XLSX (auto-detect: Invoice & Packing)")
 
 uploads = st.file_uploader("Upload one or more Valeo PDFs", type=["pdf"], accept_multiple_files=True)
 
+# ---------- patterns ----------
+# first Valeo invoice number on a line (match starts at the line start)
+_INV_RE = re.compile(r"^.*?\b(695\d{6})\b", re.MULTILINE)
+# one invoice row per match: not a header/total line, at least 7 tokens,
+# Net Price / Tot. Net as the two last tokens, and a "... Supplier(int) ...
+# Qty(int) Orig(AA) Customs(6-8d) x ..." run. The prefix skips only non-int
+# tokens and never gives them back, so Supplier is the first int token and
+# is tried once per line (a lazy prefix retried every later int token, each
+# with a walk of the greedy middle: quadratic on long int-only lines). The
+# greedy middle backs off token by token so the rightmost Qty/Orig/Customs
+# run wins. Possessive quantifiers (stdlib re, 3.11+): each class is
+# disjoint from what follows it, so giving nothing back changes no match
+# but stops backtracking inside long tokens
+_INV_ROW_RE = re.compile(
+    r"^(?!(?i:your order:|delivery note:|goods value|vat rate|transport cost"
+    r"|total gross value|currency|net price without vat))"
+    r"(?=[^\S\n]*+(?:\S++[^\S\n]++){6}\S)"
+    r"(?=.*[^\S\n](?P<net>[\d.,]++)[^\S\n]++(?P<tot>[\d.,]++)[^\S\n]*+$)"
+    r"[^\S\n]*+(?:(?!\d++[^\S\n])\S++[^\S\n]++)*+(?P<sup>\d++)[^\S\n]++(?:\S++[^\S\n]++)*(?P<qty>\d++)[^\S\n]++[A-Z]{2}[^\S\n]++\d{6,8}[^\S\n]++\S",
+    re.MULTILINE,
+)
+
+# packing footer/summary lines
+_SKIP_LINE = re.compile(r"(dimensions|total\s+net\s+weight|total\s+gross\s+weight|type\s+of\s+parcel)",
+                        re.IGNORECASE)
+# packing parcel lines ('<6+ digits> ... PALLET')
+_PALLET_WORD = re.compile(r"\b(PALLET|CARTON)\b", re.IGNORECASE)
+
 # ---------- helpers ----------
+@lru_cache(maxsize=8192)
 def eu_to_float(s: str):
-    s = str(s).strip().replace(".", "").replace(",", ".")
+    # prices repeat a lot within a file, so most calls are a cache hit.
+    # float() ignores surrounding whitespace itself, no strip() needed
     try:
-        return float(s)
-    except Exception:
+        return float(s.replace(".", "").replace(",", "."))
+    except ValueError:
         return None
 
-def read_pdf(file):
-    return pdfplumber.open(io.BytesIO(file.read()))
+def read_pdf(data: bytes):
+    return pdfplumber.open(io.BytesIO(data))
 
-def read_all_text(pdf):
-    return "\n".join([(p.extract_text() or "") for p in pdf.pages])
+def read_pdf_pages(pdf) -> list:
+    # layout-ordered text per page: pdfplumber sorts chars into visual lines,
+    # which the invoice rows depend on (content-stream order is not enough)
+    return [(p.extract_text() or "") for p in pdf.pages]
 
-# ---------- Valeo INVOICE (unchanged) ----------
-def parse_valeo_invoice_text(full_text:str) -> pd.DataFrame:
-    rows = []
-    current_inv = None
-    inv_re = re.compile(r"\b(695\d{6})\b")  # Valeo invoice number
-
-    for raw_line in (l for l in full_text.splitlines() if l.strip()):
-        m_inv = inv_re.search(raw_line)
-        if m_inv:
-            current_inv = m_inv.group(1)
-
-        low = raw_line.lower()
-        if low.startswith((
-            "your order:", "delivery note:", "goods value",
-            "vat rate", "transport cost", "currency",
-            "total gross value", "net price without vat"
-        )):
-            continue
+# ---------- Valeo INVOICE ----------
+def _invoice_blocks(full_text: str):
+    """Yield (invoice_no, start, end); a block starts at each line carrying an invoice number."""
+    inv, start = None, 0
+    for m in _INV_RE.finditer(full_text):
+        yield inv, start, m.start()
+        inv, start = m.group(1), m.start()
+    yield inv, start, len(full_text)
 
-        tok = raw_line.split()
-        if len(tok) < 7:
-            continue
+def _parse_invoice_block(full_text: str, start: int, end: int):
+    supp, qty, price, tot = [], [], [], []
 
-        # last two are Net Price, Tot. Net
-        if not (re.fullmatch(r"[\d\.,]+", tok[-1]) and re.fullmatch(r"[\d\.,]+", tok[-2])):
-            continue
+    # one scan over the block; only complete rows ever reach Python
+    for row in _INV_ROW_RE.finditer(full_text, start, end):
+        supp.append(row["sup"])
+        qty.append(int(row["qty"]))
+        price.append(eu_to_float(row["net"]))
+        tot.append(eu_to_float(row["tot"]))
 
-        # find "... Qty(int) Orig(AA) Customs(6-8d) ..."
-        j = None
-        for k in range(len(tok)-3, 1, -1):
-            if (re.fullmatch(r"[A-Z]{2}", tok[k]) and
-                k+1 < len(tok) and re.fullmatch(r"\d{6,8}", tok[k+1]) and
-                re.fullmatch(r"\d+", tok[k-1])):
-                j = k
-                break
-        if j is None:
-            continue
+    return supp, qty, price, tot
 
-        # supplier_id = first numeric token BEFORE Qty
-        supplier_token = None
-        for t in tok[:j-1]:
-            if re.fullmatch(r"\d+", t):
-                supplier_token = t
-                break
-        if not supplier_token:
-            continue
-
-        qty = int(tok[j-1])
-        net_price = eu_to_float(tok[-2])
-        tot_net   = eu_to_float(tok[-1])
-        rows.append([supplier_token, qty, net_price, tot_net, current_inv])
-
-    return pd.DataFrame(rows, columns=["Supplier_ID","Qty","Net Price","Tot. Net Value","InvoiceNo"])
+def parse_valeo_invoice_text(full_text:str) -> pd.DataFrame:
+    # lines are whatever str.splitlines() breaks on (\r, \x0b, \x0c, \x1c-\x1e,
+    # \x85, \u2028, \u2029 too); the patterns below only know \n
+    full_text = "\n".join(full_text.splitlines())
+
+    # blocks carry no state between each other, so they parse independently
+    supp, qty, price, tot, invs = [], [], [], [], []
+    for inv, start, end in _invoice_blocks(full_text):
+        b_supp, b_qty, b_price, b_tot = _parse_invoice_block(full_text, start, end)
+        supp += b_supp
+        qty += b_qty
+        price += b_price
+        tot += b_tot
+        invs += [inv] * len(b_supp)
+
+    # typed columns up front, frame built once (never append/concat in a loop).
+    # Qty stays int64 (any digit run can land there); prices stay float64.
+    # ID columns repeat a lot, so they are categoricals over the text values
+    # (text, not ints: leading zeros survive into the exports)
+    return pd.DataFrame({
+        "Supplier_ID": pd.Categorical(supp),
+        "Qty": np.asarray(qty, dtype=np.int64),
+        "Net Price": np.asarray(price, dtype=np.float64),
+        "Tot. Net Value": np.asarray(tot, dtype=np.float64),
+        "InvoiceNo": pd.Categorical(invs),
+    })
 
 # ---------- Valeo PACKING (header-locked, order-preserving, cross-page) ----------
-def parse_valeo_packing_pdf(pdf) -> pd.DataFrame:
+def read_packing_words(pdf, page_numbers) -> list:
+    # (words, page width) for each packing page
+    return [(pdf.pages[i].extract_words(use_text_flow=True, keep_blank_chars=False), pdf.pages[i].width)
+            for i in page_numbers]
+
+def parse_valeo_packing_pages(pages) -> pd.DataFrame:
     """
-    Process only pages with 'PACKING LIST'. For each such page:
+    `pages` holds (words, page_width) for each page with 'PACKING LIST', in
+    page order (see read_packing_words). For each such page:
       - detect header row where 'VALEO' and 'Quantity' sit on the same line;
       - build tight x-windows from the header tokens themselves;
       - iterate lines BELOW the header, top->bottom:
@@ -88,61 +124,47 @@ def parse_valeo_packing_pdf(pdf) -> pd.DataFrame:
         If both present and we have a current parcel -> append row.
     Keeps duplicates and preserves exact order across pages.
     """
-    rows = []
+    parcels, valeos, qtys = [], [], []
     current_parcel = None
 
-    PALLET_WORD = re.compile(r"\b(PALLET|CARTON)\b", re.IGNORECASE)
-    PARCEL_ID   = re.compile(r"^\d{6,}$")
-    SUPPLIER_ID = re.compile(r"^\d{4,8}$")
-    INT_ONLY    = re.compile(r"^\d{1,4}$")
-    SKIP_LINE   = re.compile(r"(dimensions|total\s+net\s+weight|total\s+gross\s+weight|type\s+of\s+parcel)",
-                             re.IGNORECASE)
-
-    for page in pdf.pages:
-        page_text = page.extract_text() or ""
-        if "PACKING LIST" not in page_text.upper():
-            continue
-
-        words = page.extract_words(use_text_flow=True, keep_blank_chars=False)
+    for words, page_width in pages:
         if not words:
             continue
 
         # Group into visual lines
-        line_map = defaultdict(list)
-        for w in words:
-            line_map[round(w["top"], 1)].append(w)
-        lines = [(y, sorted(ws, key=lambda x: x["x0"])) for y, ws in sorted(line_map.items(), key=lambda kv: kv[0])]
+        # one sort on (y, x0), then contiguous runs of y are the lines
+        keyed = sorted(((round(w["top"], 1), w["x0"], w) for w in words), key=lambda k: k[:2])
+        lines = [(y, [k[2] for k in grp]) for y, grp in groupby(keyed, key=itemgetter(0))]
 
         # Find header (must contain 'Quantity' and 'Valeo' on the same y)
         header = None
-        for y, ws in lines:
+        for i, (y, ws) in enumerate(lines):
             texts_lower = [w["text"].strip().lower() for w in ws]
             if "quantity" in texts_lower and any("valeo" in t for t in texts_lower):
-                header = (y, ws)
+                header = (i, ws)
                 break
         if not header:
             # skip page if header can't be found (safer than guessing)
             continue
 
-        header_y = header[0]
+        header_i = header[0]
         qty_hdrs   = [w for w in header[1] if w["text"].strip().lower() == "quantity"]
         valeo_hdrs = [w for w in header[1] if "valeo" in w["text"].strip().lower()]
 
         # tight windows from header tokens
-        qty_win   = (min(w["x0"] for w in qty_hdrs) - 1,  max(w["x1"] for w in qty_hdrs) + 60) if qty_hdrs else (page.width*0.75, page.width*0.95)
-        valeo_win = (min(w["x0"] for w in valeo_hdrs) - 10, max(w["x1"] for w in valeo_hdrs) + 20) if valeo_hdrs else (page.width*0.45, page.width*0.7)
+        qty_win   = (min(w["x0"] for w in qty_hdrs) - 1,  max(w["x1"] for w in qty_hdrs) + 60) if qty_hdrs else (page_width*0.75, page_width*0.95)
+        valeo_win = (min(w["x0"] for w in valeo_hdrs) - 10, max(w["x1"] for w in valeo_hdrs) + 20) if valeo_hdrs else (page_width*0.45, page_width*0.7)
 
-        # Walk lines in order *below* the header
-        for y, ws in lines:
-            if y <= header_y:
-                continue
-            if SKIP_LINE.search(" ".join(w["text"] for w in ws)):
+        # Walk lines in order *below* the header (lines are sorted by y)
+        for y, ws in lines[header_i + 1:]:
+            texts = [w["text"] for w in ws]
+            line = " ".join(texts)
+            if _SKIP_LINE.search(line):
                 continue
 
             # detect & set parcel if this line has PALLET
-            texts = [w["text"] for w in ws]
-            if any(PALLET_WORD.search(t) for t in texts):
-                parcel_tokens = [w["text"] for w in ws if PARCEL_ID.match(w["text"])]
+            if _PALLET_WORD.search(line):
+                parcel_tokens = [t for t in texts if len(t) >= 6 and t.isdecimal()]
                 if parcel_tokens:
                     current_parcel = parcel_tokens[0]
                 # NOTE: do not 'continue' here — the same line can contain the first item
@@ -152,40 +174,78 @@ def parse_valeo_packing_pdf(pdf) -> pd.DataFrame:
                 # so if we still don't have one, skip until first PALLET on the document
                 continue
 
+            # words are sorted by x0, so each column window is one slice
+            xs = [w["x0"] for w in ws]
+
             # supplier inside VALEO window
-            supplier_tokens = [w["text"] for w in ws
-                               if valeo_win[0] <= w["x0"] <= valeo_win[1] and SUPPLIER_ID.match(w["text"])]
-            if not supplier_tokens:
+            valeo_col = texts[bisect_left(xs, valeo_win[0]):bisect_right(xs, valeo_win[1])]
+            supplier_id = next((t for t in valeo_col if 4 <= len(t) <= 8 and t.isdecimal()), None)
+            if supplier_id is None:
                 continue
-            supplier_id = supplier_tokens[0]
 
             # quantity inside Quantity window (pure int, <= 4 digits)
-            qty_tokens = [w["text"] for w in ws
-                          if qty_win[0] <= w["x0"] <= qty_win[1] and INT_ONLY.match(w["text"])]
+            qty_col = texts[bisect_left(xs, qty_win[0]):bisect_right(xs, qty_win[1])]
+            qty_tokens = [t for t in qty_col if len(t) <= 4 and t.isdecimal()]
             if not qty_tokens:
                 continue
-            quantity = int(qty_tokens[-1])  # rightmost int in Quantity column
 
-            rows.append([current_parcel, supplier_id, quantity])
+            parcels.append(current_parcel)
+            valeos.append(supplier_id)
+            qtys.append(qty_tokens[-1])  # rightmost int in Quantity column
 
-    return pd.DataFrame(rows, columns=["Parcel N°","VALEO Material N°","Quantity"]).reset_index(drop=True)
+    return pd.DataFrame({
+        "Parcel N°": pd.Categorical(parcels),
+        "VALEO Material N°": pd.Categorical(valeos),
+        # digit strings converted in one numpy pass; qty is at most 4 digits
+        "Quantity": np.asarray(qtys, dtype=str).astype(np.int16),
+    })
 
 # ---------- autodetect ----------
-def autodetect(pdf):
-    text = read_all_text(pdf)
-    inv_df  = parse_valeo_invoice_text(text)
-    pack_df = parse_valeo_packing_pdf(pdf)
+@st.cache_data(show_spinner=False, max_entries=32)
+def autodetect(data: bytes):
+    # the one cache for parsing, keyed on the upload bytes: reruns and
+    # re-uploads hash each file once and get both frames back
+    with read_pdf(data) as pdf:
+        page_texts = read_pdf_pages(pdf)
+        # the packing gate reuses the text of the invoice pass, so no page
+        # is extracted twice; only packing pages go on to extract_words
+        pack_pages = [i for i, t in enumerate(page_texts) if "PACKING LIST" in t.upper()]
+        pack_words = read_packing_words(pdf, pack_pages)
+    inv_df  = parse_valeo_invoice_text("\n".join(page_texts))
+    pack_df = parse_valeo_packing_pages(pack_words)
     return inv_df, pack_df
 
+# ---------- export ----------
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_xlsx_bytes(df: pd.DataFrame, sheet: str) -> bytes:
+    # keyed on the frame's content, so reruns reuse the workbook instead of
+    # re-serialising it for a download button nobody clicked
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as xw:
+        df.to_excel(xw, index=False, sheet_name=sheet)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_csv_bytes(df: pd.DataFrame) -> bytes:
+    # CSV skips the workbook build entirely; utf-8-sig so Excel detects the
+    # encoding. Excel still reads the ID columns as numbers when it opens a
+    # CSV and drops their leading zeros (0012345 -> 12345); the XLSX keeps
+    # them as text
+    return df.to_csv(index=False).encode("utf-8-sig")
+
 # ---------- UI ----------
 if uploads:
     for up in uploads:
         st.markdown("---")
         st.subheader(f"File: {up.name}")
 
-        pdf = read_pdf(up)
-        inv_df, pack_df = autodetect(pdf)
-        pdf.close()
+        # getvalue() hands out the upload bytes without moving the stream.
+        # One unreadable upload only costs its own section, not the page
+        try:
+            inv_df, pack_df = autodetect(up.getvalue())
+        except Exception as e:
+            st.error(f"Could not read {up.name}: {e}")
+            continue
 
         produced_any = False
 
@@ -193,30 +253,36 @@ if uploads:
             produced_any = True
             st.write(f"**Invoice lines detected:** {len(inv_df)} rows")
             st.dataframe(inv_df, use_container_width=True, height=320)
-            buf = io.BytesIO()
-            with pd.ExcelWriter(buf, engine="openpyxl") as xw:
-                inv_df.to_excel(xw, index=False, sheet_name="InvoiceLines")
             st.download_button(
                 "Download Invoice XLSX",
-                data=buf.getvalue(),
+                data=build_xlsx_bytes(inv_df, "InvoiceLines"),
                 file_name=f"{up.name.rsplit('.',1)[0]}_invoice_lines.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
+            st.download_button(
+                "Download Invoice CSV",
+                data=build_csv_bytes(inv_df),
+                file_name=f"{up.name.rsplit('.',1)[0]}_invoice_lines.csv",
+                mime="text/csv",
+            )
 
         if len(pack_df) > 0:
             produced_any = True
             sum_qty = int(pack_df["Quantity"].sum())
             st.write(f"**Packing lines detected:** {len(pack_df)} rows  (Σ Quantity = {sum_qty})")
             st.dataframe(pack_df, use_container_width=True, height=320)
-            buf2 = io.BytesIO()
-            with pd.ExcelWriter(buf2, engine="openpyxl") as xw:
-                pack_df.to_excel(xw, index=False, sheet_name="PackingLines")
             st.download_button(
                 "Download Packing XLSX",
-                data=buf2.getvalue(),
+                data=build_xlsx_bytes(pack_df, "PackingLines"),
                 file_name=f"{up.name.rsplit('.',1)[0]}_packing_lines.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
+            st.download_button(
+                "Download Packing CSV",
+                data=build_csv_bytes(pack_df),
+                file_name=f"{up.name.rsplit('.',1)[0]}_packing_lines.csv",
+                mime="text/csv",
+            )
 
         if not produced_any:
             st.warning("No invoice or packing lines detected — is this a Valeo PDF?")
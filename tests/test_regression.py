@@ -0,0 +1,108 @@
+"""
+Regression checks for the parsers in streamlit_app_valeo_autodetect.py.
+
+The expected CSVs under tests/goldens/expected were produced by the original
+(pre-optimisation) parser; any edit to the invoice/packing patterns must keep
+them byte-identical.
+
+    python -m unittest discover tests
+"""
+import logging
+import sys
+import time
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+GOLDENS = ROOT / "tests" / "goldens"
+
+# the app is a Streamlit script: importing it outside `streamlit run` renders
+# the empty upload page in bare mode, which only logs warnings
+logging.disable(logging.WARNING)
+sys.path.insert(0, str(ROOT))
+import streamlit_app_valeo_autodetect as app  # noqa: E402
+logging.disable(logging.NOTSET)
+
+
+def _rows(df: pd.DataFrame) -> list:
+    return [[None if pd.isna(v) else v for v in r] for r in df.astype(object).values.tolist()]
+
+
+class InvoiceRowTest(unittest.TestCase):
+    def parse(self, *lines):
+        return _rows(app.parse_valeo_invoice_text("\n".join(lines)))
+
+    def test_plain_row(self):
+        self.assertEqual(
+            self.parse("INVOICE 695000111", "10 0012345 WIPER BLADE 3 FR 85122000 1.234,50 3.703,50"),
+            [["10", 3, 1234.5, 3703.5, "695000111"]],
+        )
+
+    def test_rows_before_first_invoice_number_keep_none(self):
+        self.assertEqual(
+            self.parse("10 0012345 WIPER BLADE 3 FR 85122000 1,00 3,00"),
+            [["10", 3, 1.0, 3.0, None]],
+        )
+
+    def test_rightmost_qty_orig_customs_run_wins(self):
+        self.assertEqual(
+            self.parse("20 0054321 5 DE 123456 KIT 7 FR 85122000 1,00 7,00"),
+            [["20", 7, 1.0, 7.0, None]],
+        )
+
+    def test_supplier_only_after_qty_is_no_row(self):
+        self.assertEqual(self.parse("ABC DEF 3 FR 85122000 12 1,00 3,00"), [])
+
+    def test_customs_may_be_the_net_price_token(self):
+        self.assertEqual(self.parse("30 A B C 4 IT 851220 9,50"), [["30", 4, 851220.0, 9.5, None]])
+
+    def test_skip_prefixes_and_short_lines(self):
+        self.assertEqual(
+            self.parse("Goods value 10 20 3 FR 85122000 1,00 3,00",
+                       "your order: 10 20 3 FR 85122000 1,00 3,00",
+                       "3 FR 85122000 1,00 3,00"),
+            [],
+        )
+
+    def test_splitlines_boundaries_split_rows(self):
+        # \x85 is a line break for str.splitlines(), so this is two short lines
+        self.assertEqual(self.parse("40 0012345 WIPER\x853 FR 85122000 1,00 3,00"), [])
+
+    def test_rows_follow_the_last_invoice_number(self):
+        self.assertEqual(
+            self.parse("INVOICE 695000111",
+                       "10 0012345 WIPER BLADE 3 FR 85122000 1,00 3,00",
+                       "INVOICE 695000222 page 1",
+                       "50 0099999 CLIP 12 DE 39269097 0,25 3,00"),
+            [["10", 3, 1.0, 3.0, "695000111"], ["50", 12, 0.25, 3.0, "695000222"]],
+        )
+
+    def test_long_int_only_lines_stay_fast(self):
+        # a prefix that retried every int token as Supplier made these
+        # quadratic (~0.8 s for the first line)
+        ints, pairs = " ".join(["12"] * 4000), " ".join(["12 AB"] * 2000)
+        start = time.perf_counter()
+        self.assertEqual(self.parse(ints + " 1,00 2,00", pairs + " 1,00 2,00"), [])
+        self.assertEqual(self.parse(ints + " 5 FR 85122000 1,00 2,00"), [["12", 5, 1.0, 2.0, None]])
+        self.assertLess(time.perf_counter() - start, 0.1)
+
+
+class GoldenPdfTest(unittest.TestCase):
+    def check(self, name):
+        inv_df, pack_df = app.autodetect((GOLDENS / "input" / f"{name}.pdf").read_bytes())
+        expected = GOLDENS / "expected"
+        self.assertEqual(inv_df.to_csv(index=False), (expected / f"{name}_invoice_lines.csv").read_text(encoding="utf-8"))
+        self.assertEqual(pack_df.to_csv(index=False), (expected / f"{name}_packing_lines.csv").read_text(encoding="utf-8"))
+
+    def test_smoke(self):
+        self.check("smoke")
+
+    def test_table_drawn_column_by_column(self):
+        # cells are written column-major; rows only exist in layout order
+        self.check("column_order")
+
+
+if __name__ == "__main__":
+    unittest.main()